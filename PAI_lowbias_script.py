@@ -4,30 +4,22 @@ Created during November & December 2022
 by authors Kevin Hilbert, Charlotte Meinke & Silvan Hornstein
 """
 
+import argparse
 import copy
 import csv
+import itertools
+import json
 import math
-import mkl
 import multiprocessing
 import os
-import sklearn
 import statistics
 import sys
 import time
+import traceback
 import warnings
 from multiprocessing import Pool
-import numpy as np
-import pandas as pd
-from pandas import read_csv
-from sklearn.compose import ColumnTransformer
-from sklearn.experimental import enable_iterative_imputer
-from sklearn.feature_selection import SelectFromModel
-from sklearn.impute import SimpleImputer, IterativeImputer
-from sklearn.linear_model import BayesianRidge, ElasticNet, Ridge
-from sklearn.metrics import mean_absolute_error, mean_squared_error
-from sklearn.metrics.pairwise import pairwise_distances
-from sklearn.model_selection import StratifiedKFold
-from sklearn import preprocessing
+from multiprocessing.pool import ThreadPool
+# numpy, pandas and scikit-learn are imported lazily in load_dependencies()
 
 
 """
@@ -39,6 +31,7 @@ Data preparation:
 
     Prepare the data: this script takes tab-delimited text files as input for features, labels and group membership (i.e. treatment arm). Usually, tab-delimited text can easily be exported from statistic programs or excel
     Make sure that the group membership file codes the groups as number, for instance 0 for CBT and 1 for SSRI
+    Any number of treatment arms is supported (e.g. 0 for CBT, 1 for SSRI, 2 for combined treatment); every patient is predicted under every arm
     Make sure that categorical variables are one-hot encoded as binaries, and these binaries are scaled to 0.5 and -0.5
 
     Make sure the data in these text files uses a point as decimal separator and variable names do not include special characters
@@ -52,8 +45,18 @@ Script preparation:
     Name your model in options_overall['name_model'] - this will be used to name all outputs by the script
     Set the number of total iterations under options_overall['number_iterations']
     Set the of folds for the k-fold under options_overall['number_folds']
+    Optionally, set the number of threads fitting the treatment arms concurrently under options_overall['number_arm_workers'] (defaults to the number of arms)
     Give the names of your text files including features, labels and group membership under options_overall['name_features'], options_overall['name_labels'] , options_overall['name_groups_id']
-    Use map or pool.map at the end of the script depending on whether you run this on your local computer or on a cluster
+    Use --number-workers 1 (map) on your local computer or a larger number (pool.map) on a cluster
+
+Command line:
+    Instead of editing the constants below, the script can be run non-interactively with one or more JSON config files, e.g.
+        python PAI_lowbias_script.py model_a.json model_b.json --number-workers 4
+    A config file holds 'path_workingdirectory' and any options_overall keys; values missing from it fall back to the constants below
+    Command line options (see --help) override the values in the config files
+    All config files of one call share the same worker processes, which import the dependencies only once
+    With --serve, the worker processes stay alive after the given config files, and further config file paths are read from standard input, one per line, until end of input
+    BLAS threads are limited per process with threadpoolctl (or mkl if threadpoolctl is missing) under --number-blas-threads, which defaults to NUMBER_BLAS_THREADS
 """
 
 
@@ -75,9 +78,6 @@ Refraining from LOO-CV and using a repeated 5-fold stratified train-test split -
 """
 
 
-start_time = time.time()
-mkl.set_num_threads(1)
-
 PATH_WORKINGDIRECTORY = 'your_path\\' 
 
 OPTIONS_OVERALL = {'name_model': 'name_your_model'}
@@ -86,6 +86,68 @@ OPTIONS_OVERALL['number_folds'] = 5
 OPTIONS_OVERALL['name_features'] = 'features.txt'
 OPTIONS_OVERALL['name_labels'] = 'labels.txt'
 OPTIONS_OVERALL['name_groups_id'] = 'groups_id.txt'
+OPTIONS_OVERALL['number_arm_workers'] = None
+
+NUMBER_BLAS_THREADS = 1
+BLAS_THREAD_LIMITS = None
+
+
+def load_dependencies():
+    """numpy, pandas and scikit-learn are imported on first use, so that starting the script and spawning workers stays fast"""
+    global np, pd, sklearn, read_csv, ColumnTransformer, SelectFromModel, SimpleImputer, IterativeImputer
+    global BayesianRidge, ElasticNet, Ridge, mean_absolute_error, mean_squared_error, pairwise_distances
+    global StratifiedKFold, preprocessing
+
+    import numpy as np
+    import pandas as pd
+    import sklearn
+    from pandas import read_csv
+    from sklearn.compose import ColumnTransformer
+    from sklearn.experimental import enable_iterative_imputer
+    from sklearn.feature_selection import SelectFromModel
+    from sklearn.impute import SimpleImputer, IterativeImputer
+    from sklearn.linear_model import BayesianRidge, ElasticNet, Ridge
+    from sklearn.metrics import mean_absolute_error, mean_squared_error
+    from sklearn.metrics.pairwise import pairwise_distances
+    from sklearn.model_selection import StratifiedKFold
+    from sklearn import preprocessing
+
+
+def initialize(number_blas_threads):
+    """Dependencies are imported and BLAS threads are limited, once per process (also used as initializer of the worker processes)"""
+    global BLAS_THREAD_LIMITS
+
+    # Environment variables only take effect if set before numpy is imported
+    if number_blas_threads is not None:
+        for variable in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+            os.environ.setdefault(variable, str(number_blas_threads))
+
+    load_dependencies()
+
+    if number_blas_threads is not None:
+        try:
+            from threadpoolctl import threadpool_limits
+            BLAS_THREAD_LIMITS = threadpool_limits(limits=number_blas_threads, user_api='blas')
+        except ImportError:
+            try:
+                import mkl
+                mkl.set_num_threads(number_blas_threads)
+            except ImportError:
+                pass
+
+
+def set_options(path_workingdirectory, options_overall):
+    """The working directory and options of the current model are set for this process"""
+    global PATH_WORKINGDIRECTORY, OPTIONS_OVERALL
+    PATH_WORKINGDIRECTORY = path_workingdirectory
+    OPTIONS_OVERALL = options_overall
+
+
+def run_iteration(job):
+    """A single iteration is run for the model given with the job, so that warm workers can be reused across models"""
+    path_workingdirectory, options_overall, numrun = job
+    set_options(path_workingdirectory, options_overall)
+    do_iterations(numrun)
 
 
 def create_folders():
@@ -99,6 +161,54 @@ def create_folders():
         sys.exit("Execution stopped")
 
 
+def get_arms(name_groups_id_import):
+    """The treatment arms coded in the group membership file are returned in ascending order"""
+    return np.unique(np.ravel(name_groups_id_import))
+
+
+def validate_arms(arms, name_groups_id_import, number_folds):
+    """Treatment arm codes are checked to be at least two finite integers with enough patients each, and returned as int"""
+    if len(arms) < 2:
+        raise ValueError('The group membership file must code at least two treatment arms, found {}'.format(arms.tolist()))
+    if not np.all(np.isfinite(arms)) or not np.all(np.mod(arms, 1) == 0):
+        raise ValueError('The group membership file must code treatment arms as integers without missing values, found {}'.format(arms.tolist()))
+    arms = arms.astype(int)
+    # Every fold needs test patients of every arm
+    groups_id = np.ravel(name_groups_id_import)
+    for arm in arms:
+        number_patients_arm = np.sum(groups_id == arm)
+        if number_patients_arm < number_folds:
+            raise ValueError('Treatment arm {} has {} patients, but at least {} (number_folds) patients per arm are needed'.format(arm, number_patients_arm, number_folds))
+    return arms
+
+
+def arm_name(arm):
+    """Treatment arm codes are translated into the tx_alternative naming used for all outputs"""
+    return 'tx_alternative' + str(arm)
+
+
+def fit_arm(X_train_arm, y_train_arm, X_test_arm, random_state_seed):
+    """Imputation, scaling, feature selection and Ridge regression are fitted for a single treatment arm"""
+    # Imputation missing values
+    X_train_arm_imputed, X_test_arm_imputed = mice_mode_imputation(X_train_arm, X_test_arm, random_state_seed)
+
+    # Scaling
+    X_train_arm_imputed_scaled, X_test_arm_imputed_scaled = z_scaling(X_train_arm_imputed, X_test_arm_imputed)
+
+    # Feature Selection with Elastic net
+    y_train_arm = np.ravel(y_train_arm)
+    clf_elastic = ElasticNet(alpha=1.0, l1_ratio=0.5, fit_intercept=False,
+                             max_iter=1000, tol=0.0001, random_state=random_state_seed, selection='cyclic')
+    sfm = SelectFromModel(clf_elastic, threshold="mean")
+    sfm.fit(X_train_arm_imputed_scaled, y_train_arm)
+
+    # Prediction with Ridge Regression
+    clf = Ridge(fit_intercept=False, copy_X=True, positive=False)
+    clf.fit(sfm.transform(X_train_arm_imputed_scaled), y_train_arm)
+
+    return {"sfm": sfm, "clf": clf, "X_test_imputed_scaled": X_test_arm_imputed_scaled}
+
+
 def do_iterations(numrun):
     """Runs a whole iteration of the sklearn pipeline and following calculation of the PAI score"""
     global PATH_WORKINGDIRECTORY, OPTIONS_OVERALL
@@ -116,6 +226,14 @@ def do_iterations(numrun):
     name_groups_id_import = read_csv(name_groups_id_import_path, sep="\t", header=0)
 
 
+    # Treatment arms and their row membership are derived once per iteration
+    arms = validate_arms(get_arms(name_groups_id_import), name_groups_id_import, OPTIONS_OVERALL['number_folds'])
+    arm_names = [arm_name(arm) for arm in arms]
+    groups_id = np.ravel(name_groups_id_import)
+    arm_masks = [groups_id == arm for arm in arms]
+    arm_pool = ThreadPool(OPTIONS_OVERALL.get('number_arm_workers') or len(arms))
+
+
     # Prepare variables to save outcomes
     skf = StratifiedKFold(n_splits=OPTIONS_OVERALL['number_folds'], shuffle=True, random_state=random_state_seed)
     X = features_import
@@ -123,185 +241,108 @@ def do_iterations(numrun):
     cvs = 0
 
     results_all_cvs = {
-        "correlation_all_cvs" : np.zeros((OPTIONS_OVERALL['number_folds'],2)),
-        "RMSE_all_cvs" : np.zeros((OPTIONS_OVERALL['number_folds'],2)),
-        "MAE_all_cvs" : np.zeros((OPTIONS_OVERALL['number_folds'],2)),
-        "pai_all_cvs_tx_alternative1" : [],
-        "pai_all_cvs_tx_alternative0" : [],
-        "abspai_all_cvs_tx_alternative1" : [],
-        "abspai_all_cvs_tx_alternative0" : [],
-        "pai_all_cvs_50_percent_tx_alternative1" : [],
-        "pai_all_cvs_50_percent_tx_alternative0" : [],
-        "abspai_all_cvs_50_percent_tx_alternative1" : [],
-        "abspai_all_cvs_50_percent_tx_alternative0" : [],
-        "obs_outcomes_optimal_all_cvs_tx_alternative1" : [],
-        "obs_outcomes_optimal_all_cvs_tx_alternative0" : [],
-        "obs_outcomes_nonoptimal_all_cvs_tx_alternative1" : [],
-        "obs_outcomes_nonoptimal_all_cvs_tx_alternative0" : [],
-        "obs_outcomes_optimal_all_cvs_50_percent_tx_alternative1" : [],
-        "obs_outcomes_optimal_all_cvs_50_percent_tx_alternative0" : [],
-        "obs_outcomes_nonoptimal_all_cvs_50_percent_tx_alternative1" : [],
-        "obs_outcomes_nonoptimal_all_cvs_50_percent_tx_alternative0" : [],
-        "feature_importances_all_cvs_tx_alternative1" : np.zeros((5, X.shape[1])),
-        "feature_importances_all_cvs_tx_alternative0" : np.zeros((5, X.shape[1]))
+        "correlation_all_cvs" : np.zeros((OPTIONS_OVERALL['number_folds'],len(arms))),
+        "RMSE_all_cvs" : np.zeros((OPTIONS_OVERALL['number_folds'],len(arms))),
+        "MAE_all_cvs" : np.zeros((OPTIONS_OVERALL['number_folds'],len(arms)))
         }
-
-    # Perform train-test split
-    for train_index, test_index in skf.split(X, name_groups_id_import):
-        X_train, X_test = X.iloc[train_index], X.iloc[test_index]
-        y_train, y_test = y.iloc[train_index], y.iloc[test_index]
-
-
-        # Data exclusion
-        X_train_cleaned, X_test_cleaned, features_index_copy, features_excluded = exclude_features(X_train, X_test)
-
-
-        # Split treatment groups
-        X_tx_alternative1_train = X_train_cleaned.loc[name_groups_id_import[name_groups_id_import.columns[0]] == 1]
-        X_tx_alternative1_test = X_test_cleaned.loc[name_groups_id_import[name_groups_id_import.columns[0]] == 1]
-        X_tx_alternative0_train = X_train_cleaned.loc[name_groups_id_import[name_groups_id_import.columns[0]] == 0]
-        X_tx_alternative0_test = X_test_cleaned.loc[name_groups_id_import[name_groups_id_import.columns[0]] == 0]
-        y_tx_alternative1_train = y_train.loc[name_groups_id_import[name_groups_id_import.columns[0]] == 1]
-        y_tx_alternative1_test = y_test.loc[name_groups_id_import[name_groups_id_import.columns[0]] == 1]
-        y_tx_alternative0_train = y_train.loc[name_groups_id_import[name_groups_id_import.columns[0]] == 0]
-        y_tx_alternative0_test = y_test.loc[name_groups_id_import[name_groups_id_import.columns[0]] == 0]
-
-
-        # Imputation missing values
-        X_tx_alternative1_train_imputed, X_tx_alternative1_test_imputed = mice_mode_imputation(X_tx_alternative1_train, X_tx_alternative1_test, random_state_seed)
-        X_tx_alternative0_train_imputed, X_tx_alternative0_test_imputed = mice_mode_imputation(X_tx_alternative0_train, X_tx_alternative0_test, random_state_seed)
-
-
-        # Scaling
-        X_tx_alternative1_train_imputed_scaled, X_tx_alternative1_test_imputed_scaled = z_scaling(X_tx_alternative1_train_imputed, X_tx_alternative1_test_imputed)
-        X_tx_alternative0_train_imputed_scaled, X_tx_alternative0_test_imputed_scaled = z_scaling(X_tx_alternative0_train_imputed, X_tx_alternative0_test_imputed)
-
-
-        # Feature Selection with Elastic net
-        y_tx_alternative1_train=np.ravel(y_tx_alternative1_train)
-        y_tx_alternative0_train=np.ravel(y_tx_alternative0_train)
-
-        # Alternative 1
-        clf_elastic_tx_alternative1 = ElasticNet(alpha=1.0, l1_ratio=0.5, fit_intercept=False,
-                                                 max_iter=1000, tol=0.0001, random_state=random_state_seed, selection='cyclic')
-        sfm_tx_alternative1 = SelectFromModel(clf_elastic_tx_alternative1, threshold="mean")
-        sfm_tx_alternative1.fit(X_tx_alternative1_train_imputed_scaled, y_tx_alternative1_train)
-
-        # Alternative 0
-        clf_elastic_tx_alternative0 = ElasticNet(alpha=1.0, l1_ratio=0.5, fit_intercept=False,
-                                                 max_iter=1000, tol=0.0001, random_state=random_state_seed, selection='cyclic')
-        sfm_tx_alternative0 = SelectFromModel(clf_elastic_tx_alternative0, threshold="mean")
-        sfm_tx_alternative0.fit(X_tx_alternative0_train_imputed_scaled, y_tx_alternative0_train)
-
-
-        # Feature Selection Factual
-        X_tx_alternative1_train_imputed_scaled_selected_factual = sfm_tx_alternative1.transform(X_tx_alternative1_train_imputed_scaled)
-        X_tx_alternative1_test_imputed_scaled_selected_factual = sfm_tx_alternative1.transform(X_tx_alternative1_test_imputed_scaled)
-        X_tx_alternative0_train_imputed_scaled_selected_factual = sfm_tx_alternative0.transform(X_tx_alternative0_train_imputed_scaled)
-        X_tx_alternative0_test_imputed_scaled_selected_factual = sfm_tx_alternative0.transform(X_tx_alternative0_test_imputed_scaled)
-
-
-        # Feature Selection Counterfactual
-        X_tx_alternative1_test_imputed_scaled_selected_counterfactual = sfm_tx_alternative0.transform(X_tx_alternative1_test_imputed_scaled)
-        X_tx_alternative0_test_imputed_scaled_selected_counterfactual = sfm_tx_alternative1.transform(X_tx_alternative0_test_imputed_scaled)
-
-
-        # Prediction with Ridge Regression
-        y_tx_alternative1_train = np.ravel(y_tx_alternative1_train)
-        y_tx_alternative0_train = np.ravel(y_tx_alternative0_train)
-        y_tx_alternative1_test = np.ravel(y_tx_alternative1_test)
-        y_tx_alternative0_test = np.ravel(y_tx_alternative0_test)
-
-        clf_tx_alternative1 = Ridge(fit_intercept=False, copy_X=True, positive=False)
-        clf_tx_alternative1.fit(X_tx_alternative1_train_imputed_scaled_selected_factual, y_tx_alternative1_train)
-        clf_tx_alternative0 = Ridge(fit_intercept=False, copy_X=True, positive=False)
-        clf_tx_alternative0.fit(X_tx_alternative0_train_imputed_scaled_selected_factual, y_tx_alternative0_train)
-
-        y_prediction_tx_alternative1 = pd.DataFrame()
-        y_prediction_tx_alternative1["y_pred_factual"] = clf_tx_alternative1.predict(X_tx_alternative1_test_imputed_scaled_selected_factual)
-        y_prediction_tx_alternative1["y_true"] = y_tx_alternative1_test[:]
-        y_prediction_tx_alternative1["y_pred_counterfactual"] = clf_tx_alternative0.predict(X_tx_alternative1_test_imputed_scaled_selected_counterfactual)
-
-        y_prediction_tx_alternative0 = pd.DataFrame()
-        y_prediction_tx_alternative0["y_pred_factual"] = clf_tx_alternative0.predict(X_tx_alternative0_test_imputed_scaled_selected_factual)
-        y_prediction_tx_alternative0["y_true"] = y_tx_alternative0_test[:]
-        y_prediction_tx_alternative0["y_pred_counterfactual"] = clf_tx_alternative1.predict(X_tx_alternative0_test_imputed_scaled_selected_counterfactual)
-
-
-        # Results Processing
-
-        # Get importances for each feature
-        # Alternative 1
-        feature_importances_tx_alternative1 = copy.deepcopy(features_excluded)
-        feature_importances_tx_alternative1[feature_importances_tx_alternative1==1]=np.nan
-
-        counter_features_selected_tx_alternative1 = 0
-        for number_features_tx_alternative1 in range(len(sfm_tx_alternative1.get_support())):
-            if sfm_tx_alternative1.get_support()[number_features_tx_alternative1] == True:
-                feature_importances_tx_alternative1[features_index_copy[number_features_tx_alternative1]] = clf_tx_alternative1.coef_[counter_features_selected_tx_alternative1]
-
-                counter_features_selected_tx_alternative1 = counter_features_selected_tx_alternative1 + 1
-            else:
-                feature_importances_tx_alternative1[features_index_copy[number_features_tx_alternative1]] = 0
-
-        # Alternative 0
-        feature_importances_tx_alternative0 = copy.deepcopy(features_excluded)
-        feature_importances_tx_alternative0[feature_importances_tx_alternative0==1]=np.nan
-
-        counter_features_selected_tx_alternative0 = 0
-        for number_features_tx_alternative0 in range(len(sfm_tx_alternative0.get_support())):
-            if sfm_tx_alternative0.get_support()[number_features_tx_alternative0] == True:
-                feature_importances_tx_alternative0[features_index_copy[number_features_tx_alternative0]] = clf_tx_alternative0.coef_[counter_features_selected_tx_alternative0]
-                counter_features_selected_tx_alternative0 = counter_features_selected_tx_alternative0 + 1
-            else:
-                feature_importances_tx_alternative0[features_index_copy[number_features_tx_alternative0]] = 0
-
-
-        results_metrics_alternative1 = result_metrics(y_prediction_tx_alternative1)
-        results_metrics_alternative0 = result_metrics(y_prediction_tx_alternative0)
-
-        # Create an overview for values of both treatments across FOLDS
-        results_all_cvs["correlation_all_cvs"][cvs,0] = results_metrics_alternative1["correlation"]
-        results_all_cvs["correlation_all_cvs"][cvs,1] =  results_metrics_alternative0["correlation"]
-        results_all_cvs["RMSE_all_cvs"][cvs,0] = results_metrics_alternative1["RMSE"]
-        results_all_cvs["RMSE_all_cvs"][cvs,1] = results_metrics_alternative0["RMSE"]
-        results_all_cvs["MAE_all_cvs"][cvs,0] = results_metrics_alternative1["MAE"]
-        results_all_cvs["MAE_all_cvs"][cvs,1] = results_metrics_alternative0["MAE"]
-
-        results_all_cvs["pai_all_cvs_tx_alternative1"].append(results_metrics_alternative1["pai"])
-        results_all_cvs["pai_all_cvs_tx_alternative0"].append(results_metrics_alternative0["pai"])
-        results_all_cvs["abspai_all_cvs_tx_alternative1"].append(results_metrics_alternative1["abspai"])
-        results_all_cvs["abspai_all_cvs_tx_alternative0"].append(results_metrics_alternative0["abspai"])
-        results_all_cvs["obs_outcomes_optimal_all_cvs_tx_alternative1"].append(results_metrics_alternative1["obs_outcomes_optimal"])
-        results_all_cvs["obs_outcomes_optimal_all_cvs_tx_alternative0"].append(results_metrics_alternative0["obs_outcomes_optimal"])
-        results_all_cvs["obs_outcomes_nonoptimal_all_cvs_tx_alternative1"].append(results_metrics_alternative1["obs_outcomes_nonoptimal"])
-        results_all_cvs["obs_outcomes_nonoptimal_all_cvs_tx_alternative0"].append(results_metrics_alternative0["obs_outcomes_nonoptimal"])
-
-        results_all_cvs["feature_importances_all_cvs_tx_alternative1"][cvs] = feature_importances_tx_alternative1.T
-        results_all_cvs["feature_importances_all_cvs_tx_alternative0"][cvs] = feature_importances_tx_alternative0.T
-
-        results_all_cvs["pai_all_cvs_50_percent_tx_alternative1"].append(results_metrics_alternative1["pai_50_percent"])
-        results_all_cvs["pai_all_cvs_50_percent_tx_alternative0"].append(results_metrics_alternative0["pai_50_percent"])
-        results_all_cvs["abspai_all_cvs_50_percent_tx_alternative1"].append(results_metrics_alternative1["abspai_50_percent"])
-        results_all_cvs["abspai_all_cvs_50_percent_tx_alternative0"].append(results_metrics_alternative0["abspai_50_percent"])
-        results_all_cvs["obs_outcomes_optimal_all_cvs_50_percent_tx_alternative1"].append(results_metrics_alternative1["obs_outcomes_optimal_pai_50_percent"])
-        results_all_cvs["obs_outcomes_optimal_all_cvs_50_percent_tx_alternative0"].append(results_metrics_alternative0["obs_outcomes_optimal_pai_50_percent"])
-        results_all_cvs["obs_outcomes_nonoptimal_all_cvs_50_percent_tx_alternative1"].append(results_metrics_alternative1["obs_outcomes_nonoptimal_pai_50_percent"])
-        results_all_cvs["obs_outcomes_nonoptimal_all_cvs_50_percent_tx_alternative0"].append(results_metrics_alternative0["obs_outcomes_nonoptimal_pai_50_percent"])
-
-        cvs = cvs + 1
+    per_arm_keys = ("pai_all_cvs", "abspai_all_cvs", "pai_all_cvs_50_percent", "abspai_all_cvs_50_percent",
+                    "obs_outcomes_optimal_all_cvs", "obs_outcomes_nonoptimal_all_cvs",
+                    "obs_outcomes_optimal_all_cvs_50_percent", "obs_outcomes_nonoptimal_all_cvs_50_percent")
+    for name in arm_names:
+        for key in per_arm_keys:
+            results_all_cvs[key + "_" + name] = []
+        results_all_cvs["feature_importances_all_cvs_" + name] = np.zeros((OPTIONS_OVERALL['number_folds'], X.shape[1]))
+
+    try:
+        # Perform train-test split
+        for train_index, test_index in skf.split(X, name_groups_id_import):
+            X_train, X_test = X.iloc[train_index], X.iloc[test_index]
+            y_train, y_test = y.iloc[train_index], y.iloc[test_index]
+
+
+            # Data exclusion
+            X_train_cleaned, X_test_cleaned, features_index_copy, features_excluded = exclude_features(X_train, X_test)
+
+
+            # Split treatment groups (positions within the train and test set)
+            arm_train_positions = [np.flatnonzero(arm_mask[train_index]) for arm_mask in arm_masks]
+            arm_test_positions = [np.flatnonzero(arm_mask[test_index]) for arm_mask in arm_masks]
+
+
+            # Imputation, scaling, feature selection and Ridge regression are fitted independently per treatment arm
+            fit_arm_args = [(X_train_cleaned.iloc[arm_train_positions[k]], y_train.iloc[arm_train_positions[k]],
+                             X_test_cleaned.iloc[arm_test_positions[k]], random_state_seed) for k in range(len(arms))]
+            fitted_arms = arm_pool.starmap(fit_arm, fit_arm_args)
+
+
+            # Predict every patient in the testset under every treatment arm (patients x arms)
+            # Test features of each patient are imputed and scaled as in the arm the patient actually received
+            y_prediction_all_arms = np.zeros((len(test_index), len(arms)))
+            for k_factual in range(len(arms)):
+                for k_predicted in range(len(arms)):
+                    X_test_selected = fitted_arms[k_predicted]["sfm"].transform(fitted_arms[k_factual]["X_test_imputed_scaled"])
+                    y_prediction_all_arms[arm_test_positions[k_factual], k_predicted] = fitted_arms[k_predicted]["clf"].predict(X_test_selected)
+
+
+            # Results Processing
+            y_test = np.ravel(y_test)
+            for k in range(len(arms)):
+                name = arm_names[k]
+                sfm = fitted_arms[k]["sfm"]
+                clf = fitted_arms[k]["clf"]
+
+                # Counterfactual is the best (lowest) predicted outcome among all other treatment arms
+                y_prediction = pd.DataFrame()
+                y_prediction["y_pred_factual"] = y_prediction_all_arms[arm_test_positions[k], k]
+                y_prediction["y_true"] = y_test[arm_test_positions[k]]
+                y_prediction["y_pred_counterfactual"] = np.min(np.delete(y_prediction_all_arms[arm_test_positions[k]], k, axis=1), axis=1)
+
+                # Get importances for each feature
+                feature_importances = copy.deepcopy(features_excluded)
+                feature_importances[feature_importances==1]=np.nan
+
+                counter_features_selected = 0
+                for number_features in range(len(sfm.get_support())):
+                    if sfm.get_support()[number_features] == True:
+                        feature_importances[features_index_copy[number_features]] = clf.coef_[counter_features_selected]
+                        counter_features_selected = counter_features_selected + 1
+                    else:
+                        feature_importances[features_index_copy[number_features]] = 0
+
+                results_metrics_arm = result_metrics(y_prediction)
+
+                # Create an overview for values of all treatments across FOLDS
+                # Columns are in descending order of the arm code, as tx_alternative1 before tx_alternative0 in two-arm runs
+                column = len(arms) - 1 - k
+                results_all_cvs["correlation_all_cvs"][cvs,column] = results_metrics_arm["correlation"]
+                results_all_cvs["RMSE_all_cvs"][cvs,column] = results_metrics_arm["RMSE"]
+                results_all_cvs["MAE_all_cvs"][cvs,column] = results_metrics_arm["MAE"]
+
+                results_all_cvs["pai_all_cvs_" + name].append(results_metrics_arm["pai"])
+                results_all_cvs["abspai_all_cvs_" + name].append(results_metrics_arm["abspai"])
+                results_all_cvs["obs_outcomes_optimal_all_cvs_" + name].append(results_metrics_arm["obs_outcomes_optimal"])
+                results_all_cvs["obs_outcomes_nonoptimal_all_cvs_" + name].append(results_metrics_arm["obs_outcomes_nonoptimal"])
+
+                results_all_cvs["feature_importances_all_cvs_" + name][cvs] = feature_importances.T
+
+                results_all_cvs["pai_all_cvs_50_percent_" + name].append(results_metrics_arm["pai_50_percent"])
+                results_all_cvs["abspai_all_cvs_50_percent_" + name].append(results_metrics_arm["abspai_50_percent"])
+                results_all_cvs["obs_outcomes_optimal_all_cvs_50_percent_" + name].append(results_metrics_arm["obs_outcomes_optimal_pai_50_percent"])
+                results_all_cvs["obs_outcomes_nonoptimal_all_cvs_50_percent_" + name].append(results_metrics_arm["obs_outcomes_nonoptimal_pai_50_percent"])
+
+            cvs = cvs + 1
+    finally:
+        arm_pool.close()
+        arm_pool.join()
 
     # Concatenate results per list of numpy arrays
     for key in results_all_cvs:
-        if key not in ("correlation_all_cvs","RMSE_all_cvs","MAE_all_cvs", "feature_importances_all_cvs_tx_alternative0","feature_importances_all_cvs_tx_alternative1"):
+        if key not in ("correlation_all_cvs","RMSE_all_cvs","MAE_all_cvs") and not key.startswith("feature"):
             results_all_cvs[key] = np.concatenate(results_all_cvs[key], axis=0)
-    # Concatenate results across treatments
+    # Concatenate results across treatments (descending order of the arm code, as tx_alternative1 before tx_alternative0 in two-arm runs)
     results_all_cvs_all = {}
-    for key_alt1 in results_all_cvs:
-        if key_alt1.endswith("alternative1") and not key_alt1.startswith("feature"):
-            key_alt0 = key_alt1.replace("alternative1","alternative0")
-            key_all = key_alt1.replace("_tx_alternative1","_all")
-            results_all_cvs_all[key_all] = np.concatenate((results_all_cvs[key_alt1],results_all_cvs[key_alt0]),axis = 0)
+    for key in per_arm_keys:
+        results_all_cvs_all[key + "_all"] = np.concatenate([results_all_cvs[key + "_" + name] for name in arm_names[::-1]], axis = 0)
     results_all_cvs.update(results_all_cvs_all)
 
     results_all_cv_sum = {}
@@ -316,30 +357,27 @@ def do_iterations(numrun):
 
     # Calculate Cohen´s d
     def cohens_d(x,y):
-        """Cohens D is calculated"""
+        """Cohens D is calculated, or set to NaN if a group has less than two patients (more likely with many treatment arms)"""
+        if len(x) < 2 or len(y) < 2:
+            return np.nan
         d = (statistics.mean(x) - statistics.mean(y)) / math.sqrt((statistics.stdev(x) ** 2 + statistics.stdev(y) ** 2)/2)
         return d
-    results_all_cv_sum["cohens_d_tx_alternative1"] = cohens_d(x = results_all_cvs["obs_outcomes_optimal_all_cvs_tx_alternative1"],y = results_all_cvs["obs_outcomes_nonoptimal_all_cvs_tx_alternative1"])
-    results_all_cv_sum["cohens_d_tx_alternative0"] = cohens_d(x = results_all_cvs["obs_outcomes_optimal_all_cvs_tx_alternative0"],y = results_all_cvs["obs_outcomes_nonoptimal_all_cvs_tx_alternative0"])
-    results_all_cv_sum["cohens_d_all"] = cohens_d(x = results_all_cvs["obs_outcomes_optimal_all_cvs_all"],y = results_all_cvs["obs_outcomes_nonoptimal_all_cvs_all"])
-    results_all_cv_sum["cohens_d_50_percent_tx_alternative1"] = cohens_d(x = results_all_cvs["obs_outcomes_optimal_all_cvs_50_percent_tx_alternative1"],y = results_all_cvs["obs_outcomes_nonoptimal_all_cvs_50_percent_tx_alternative1"])
-    results_all_cv_sum["cohens_d_50_percent_tx_alternative0"] = cohens_d(x = results_all_cvs["obs_outcomes_optimal_all_cvs_50_percent_tx_alternative0"],y = results_all_cvs["obs_outcomes_nonoptimal_all_cvs_50_percent_tx_alternative0"])
-    results_all_cv_sum["cohens_d_50_percent_all"] = cohens_d(x = results_all_cvs["obs_outcomes_optimal_all_cvs_50_percent_all"],y = results_all_cvs["obs_outcomes_nonoptimal_all_cvs_50_percent_all"])
+    for name in arm_names + ["all"]:
+        results_all_cv_sum["cohens_d_" + name] = cohens_d(x = results_all_cvs["obs_outcomes_optimal_all_cvs_" + name],y = results_all_cvs["obs_outcomes_nonoptimal_all_cvs_" + name])
+        results_all_cv_sum["cohens_d_50_percent_" + name] = cohens_d(x = results_all_cvs["obs_outcomes_optimal_all_cvs_50_percent_" + name],y = results_all_cvs["obs_outcomes_nonoptimal_all_cvs_50_percent_" + name])
 
     # Save results of each result-metric in file
     save_results(results_all_cv_sum)
 
     # Feature importances
-    # Alternative 1
-    feature_importances_all_cv_sum_tx_alternative1 = np.nanmean(results_all_cvs["feature_importances_all_cvs_tx_alternative1"], axis = 0)
-    feature_importances_all_cv_sum_nans_tx_alternative1 = sum(np.isnan(results_all_cvs["feature_importances_all_cvs_tx_alternative1"]))
-    feature_importances_all_cv_sum_nonzero_tx_alternative1 = np.count_nonzero(results_all_cvs["feature_importances_all_cvs_tx_alternative1"], axis=0)-sum(np.isnan(results_all_cvs["feature_importances_all_cvs_tx_alternative1"]))
-    # Alternative 0
-    feature_importances_all_cv_sum_tx_alternative0 = np.nanmean(results_all_cvs["feature_importances_all_cvs_tx_alternative0"], axis = 0)
-    feature_importances_all_cv_sum_nans_tx_alternative0 = sum(np.isnan(results_all_cvs["feature_importances_all_cvs_tx_alternative0"]))
-    feature_importances_all_cv_sum_nonzero_tx_alternative0 = np.count_nonzero(results_all_cvs["feature_importances_all_cvs_tx_alternative0"], axis=0)-sum(np.isnan(results_all_cvs["feature_importances_all_cvs_tx_alternative0"]))
+    feature_importances_all_cv_sum = {}
+    for name in arm_names:
+        feature_importances_all_cvs = results_all_cvs["feature_importances_all_cvs_" + name]
+        feature_importances_all_cv_sum["feature_importances_all_cv_sum_" + name] = np.nanmean(feature_importances_all_cvs, axis = 0)
+        feature_importances_all_cv_sum["feature_importances_all_cv_sum_NaNs_" + name] = sum(np.isnan(feature_importances_all_cvs))
+        feature_importances_all_cv_sum["feature_importances_all_cv_sum_nonzero_" + name] = np.count_nonzero(feature_importances_all_cvs, axis=0)-sum(np.isnan(feature_importances_all_cvs))
 
-    save_features(feature_importances_all_cv_sum_tx_alternative1,feature_importances_all_cv_sum_tx_alternative0,feature_importances_all_cv_sum_nans_tx_alternative1,feature_importances_all_cv_sum_nans_tx_alternative0,feature_importances_all_cv_sum_nonzero_tx_alternative1,feature_importances_all_cv_sum_nonzero_tx_alternative0)
+    save_features(feature_importances_all_cv_sum)
 
 
 def save_results(results_dict_func):
@@ -353,20 +391,15 @@ def save_results(results_dict_func):
             writer.writerow([str(results_dict_func[key])])
 
 
-def save_features(*argv):
+def save_features(features_dict_func):
     """Features are saved for the individual rounds in the defined working directory"""
-    varnames=list(('feature_importances_all_cv_sum_tx_alternative1','feature_importances_all_cv_sum_tx_alternative0','feature_importances_all_cv_sum_NaNs_tx_alternative1','feature_importances_all_cv_sum_NaNs_tx_alternative0','feature_importances_all_cv_sum_nonzero_tx_alternative1','feature_importances_all_cv_sum_nonzero_tx_alternative0'))
-    counter=0
+    for key in features_dict_func:
 
-    for arg in argv:
-
-        save_option = os.path.join(PATH_WORKINGDIRECTORY,OPTIONS_OVERALL['name_model'],'individual_rounds',(OPTIONS_OVERALL['name_model'] + '_per_iteration_' + str(varnames[counter]) + '.txt' ))
+        save_option = os.path.join(PATH_WORKINGDIRECTORY,OPTIONS_OVERALL['name_model'],'individual_rounds',(OPTIONS_OVERALL['name_model'] + '_per_iteration_' + str(key) + '.txt' ))
 
         with open(save_option,'a', newline='') as fd:
             writer = csv.writer(fd,delimiter=',')
-            writer.writerow(arg)
-
-        counter=counter+1
+            writer.writerow(features_dict_func[key])
 
 
 def exclude_features(X_train, X_test):
@@ -519,6 +552,7 @@ def result_metrics(y_prediction):
     # PAI
     pai = np.zeros((len(y_prediction),1))
     pai = y_prediction['y_pred_factual'] - y_prediction['y_pred_counterfactual'] # y_pred_factual - y_pred_counterfactual: #positive Value: counterfactual predicted to be superior to factual, as lower severity scores are better
+    # With more than two arms, y_pred_counterfactual is the best predicted alternative, so a negative PAI means the factual arm is the predicted optimal arm
     abspai = abs(pai)
 
     # Observed outcome optimal / nonoptimal
@@ -557,22 +591,23 @@ def result_metrics(y_prediction):
 
 
 def aggregate_iterations():
-    """The results of the single iterations are loaded, aggregated (means, max and min and std values) and saved."""
+    """The results of the single iterations are loaded, aggregated (means, max and min and std values, ignoring NaN iterations) and saved."""
     global PATH_WORKINGDIRECTORY, OPTIONS_OVERALL
 
-    varnames=list(('correlation_all_cv_sum_all','RMSE_all_cv_sum_all','MAE_all_cv_sum_all',
-                   'pai_all_cv_sum_tx_alternative1','pai_all_cv_sum_tx_alternative0','pai_all_cv_sum_all',
-                   'abspai_all_cv_sum_tx_alternative1','abspai_all_cv_sum_tx_alternative0','abspai_all_cv_sum_all',
-                   'cohens_d_tx_alternative1','cohens_d_tx_alternative0','cohens_d_all',
-                   'obs_outcomes_optimal_all_cv_sum_tx_alternative1', 'obs_outcomes_nonoptimal_all_cv_sum_tx_alternative1',
-                   'obs_outcomes_optimal_all_cv_sum_tx_alternative0', 'obs_outcomes_nonoptimal_all_cv_sum_tx_alternative0',
-                   'obs_outcomes_optimal_all_cv_sum_all', 'obs_outcomes_nonoptimal_all_cv_sum_all',
-                   'pai_all_cv_sum_50_percent_tx_alternative1','pai_all_cv_sum_50_percent_tx_alternative0','pai_all_cv_sum_50_percent_all',
-                   'abspai_all_cv_sum_50_percent_tx_alternative1','abspai_all_cv_sum_50_percent_tx_alternative0','abspai_all_cv_sum_50_percent_all',
-                   'cohens_d_50_percent_tx_alternative1','cohens_d_50_percent_tx_alternative0','cohens_d_50_percent_all',
-                   'obs_outcomes_optimal_all_cv_sum_50_percent_tx_alternative1','obs_outcomes_nonoptimal_all_cv_sum_50_percent_tx_alternative1',
-                   'obs_outcomes_optimal_all_cv_sum_50_percent_tx_alternative0','obs_outcomes_nonoptimal_all_cv_sum_50_percent_tx_alternative0',
-                   'obs_outcomes_optimal_all_cv_sum_50_percent_all','obs_outcomes_nonoptimal_all_cv_sum_50_percent_all'))
+    name_groups_id_import_path = os.path.join(PATH_WORKINGDIRECTORY,'data',OPTIONS_OVERALL['name_groups_id'])
+    name_groups_id_import = read_csv(name_groups_id_import_path, sep="\t", header=0)
+    arm_names = [arm_name(arm) for arm in validate_arms(get_arms(name_groups_id_import), name_groups_id_import, OPTIONS_OVERALL['number_folds'])]
+    group_names = arm_names + ['all']
+    # Arms are reported in descending order of their code, as tx_alternative1 before tx_alternative0 in two-arm reports
+    report_group_names = arm_names[::-1] + ['all']
+
+    varnames = ['correlation_all_cv_sum_all','RMSE_all_cv_sum_all','MAE_all_cv_sum_all']
+    for metric in ('pai_all_cv_sum_','abspai_all_cv_sum_','cohens_d_',
+                   'obs_outcomes_optimal_all_cv_sum_','obs_outcomes_nonoptimal_all_cv_sum_',
+                   'pai_all_cv_sum_50_percent_','abspai_all_cv_sum_50_percent_','cohens_d_50_percent_',
+                   'obs_outcomes_optimal_all_cv_sum_50_percent_','obs_outcomes_nonoptimal_all_cv_sum_50_percent_'):
+        for group_name in group_names:
+            varnames.append(metric + group_name)
 
     # Load results and create dictionary
     results_dict_aggregate = {}
@@ -583,16 +618,20 @@ def aggregate_iterations():
         loaded_var = np.loadtxt(save_option, delimiter=",", unpack=False)
         # Create dictionary with needed values
         results_dict_aggregate[var_name] = {}
+        # Iterations with NaN (e.g. Cohens D with less than two patients in a group) are left out and counted
         if OPTIONS_OVERALL["number_iterations"] > 1:
-            results_dict_aggregate[var_name]["Min"]= min(loaded_var)
-            results_dict_aggregate[var_name]["Max"]= max(loaded_var)
-            results_dict_aggregate[var_name]["Mean"]= np.mean(loaded_var)
-            results_dict_aggregate[var_name]["Std"]= np.std(loaded_var)
+            with warnings.catch_warnings(): # Ignore warning when all iterations are NaN
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                results_dict_aggregate[var_name]["Min"]= np.nanmin(loaded_var)
+                results_dict_aggregate[var_name]["Max"]= np.nanmax(loaded_var)
+                results_dict_aggregate[var_name]["Mean"]= np.nanmean(loaded_var)
+                results_dict_aggregate[var_name]["Std"]= np.nanstd(loaded_var)
         elif OPTIONS_OVERALL["number_iterations"] == 1:
             results_dict_aggregate[var_name]["Min"]= "NA"
             results_dict_aggregate[var_name]["Max"]= "NA"
             results_dict_aggregate[var_name]["Mean"]= loaded_var
             results_dict_aggregate[var_name]["Std"]= "NA"
+        results_dict_aggregate[var_name]["NaNs"]= int(np.sum(np.isnan(loaded_var)))
 
 
     # Write results into file
@@ -608,90 +647,170 @@ def aggregate_iterations():
         for key in results_dict_aggregate[outcome]:
             f.write ('\n'+ str(key) + ' ' + naming + ': '+ str(results_dict_aggregate[outcome][key]))
 
-    f.write('\n\nCorrelation, MAE and RMSE values for across both groups in testset')
+    f.write('\n\nCorrelation, MAE and RMSE values for across ' + ('both' if len(arm_names) == 2 else 'all') + ' groups in testset')
     write_metrics(outcome = "correlation_all_cv_sum_all", naming = "Correlation all")
     write_metrics(outcome = "RMSE_all_cv_sum_all", naming = "RMSE all")
     write_metrics(outcome = "MAE_all_cv_sum_all", naming = "MAE all")
 
     f.write('\n\nAbsolute scores for the PAI (abspai) in testset')
-    write_metrics(outcome = "abspai_all_cv_sum_tx_alternative1", naming = "abspai tx_alternative1")
-    write_metrics(outcome = "abspai_all_cv_sum_tx_alternative0", naming = "abspai tx_alternative0")
-    write_metrics(outcome = "abspai_all_cv_sum_all", naming = "abspai all")
+    for group_name in report_group_names:
+        write_metrics(outcome = "abspai_all_cv_sum_" + group_name, naming = "abspai " + group_name)
 
     f.write('\n\nNon-absolute scores for the PAI (abspai) in testset')
-    write_metrics(outcome = "pai_all_cv_sum_tx_alternative1", naming = "pai tx_alternative1")
-    write_metrics(outcome = "pai_all_cv_sum_tx_alternative0", naming = "pai tx_alternative0")
-    write_metrics(outcome = "pai_all_cv_sum_all", naming = "pai all")
+    for group_name in report_group_names:
+        write_metrics(outcome = "pai_all_cv_sum_" + group_name, naming = "pai " + group_name)
 
     f.write('\n\nMean observed outcome scores for treatment alternatives (tx_alternative), for patients where this was predicted as optimal and nonoptimal in testset')
-    write_metrics(outcome = "obs_outcomes_optimal_all_cv_sum_tx_alternative1", naming = "mean_obs_outcomes_optimal tx_alternative1")
-    write_metrics(outcome = "obs_outcomes_nonoptimal_all_cv_sum_tx_alternative1", naming = "mean_obs_outcomes_nonoptimal tx_alternative1")
-    write_metrics(outcome = "obs_outcomes_optimal_all_cv_sum_tx_alternative0", naming = "mean_obs_outcomes_optimal tx_alternative0")
-    write_metrics(outcome = "obs_outcomes_nonoptimal_all_cv_sum_tx_alternative0", naming = "mean_obs_outcomes_nonoptimal tx_alternative0")
-    write_metrics(outcome = "obs_outcomes_optimal_all_cv_sum_all", naming = "mean_obs_outcomes_optimal all")
-    write_metrics(outcome = "obs_outcomes_nonoptimal_all_cv_sum_all", naming = "mean_obs_outcomes_nonoptimal all")
+    for group_name in report_group_names:
+        write_metrics(outcome = "obs_outcomes_optimal_all_cv_sum_" + group_name, naming = "mean_obs_outcomes_optimal " + group_name)
+        write_metrics(outcome = "obs_outcomes_nonoptimal_all_cv_sum_" + group_name, naming = "mean_obs_outcomes_nonoptimal " + group_name)
 
     f.write('\n\nMean of Cohens D for these differences in testset')
-    write_metrics(outcome = "cohens_d_tx_alternative1", naming = "Cohens D tx_alternative1")
-    write_metrics(outcome = "cohens_d_tx_alternative0", naming = "Cohens D tx_alternative0")
-    write_metrics(outcome = "cohens_d_all", naming = "Cohens D all")
+    for group_name in report_group_names:
+        write_metrics(outcome = "cohens_d_" + group_name, naming = "Cohens D " + group_name)
 
     f.write('\n\nAbsolute scores for the PAI for the subsample with 50% largest PAIs (abspai_50_percent) in testset')
-    write_metrics(outcome = "abspai_all_cv_sum_50_percent_tx_alternative1", naming = "abspai_50_percent tx_alternative1")
-    write_metrics(outcome = "abspai_all_cv_sum_50_percent_tx_alternative0", naming = "abspai_50_percent tx_alternative0")
-    write_metrics(outcome = "abspai_all_cv_sum_50_percent_all", naming = "abspai_50_percent all")
+    for group_name in report_group_names:
+        write_metrics(outcome = "abspai_all_cv_sum_50_percent_" + group_name, naming = "abspai_50_percent " + group_name)
 
     f.write('\n\nNon-absolute scores for the PAI for the subsample with 50% largest PAIs in testset')
-    write_metrics(outcome = "pai_all_cv_sum_50_percent_tx_alternative1", naming = "pai_50_percent tx_alternative1")
-    write_metrics(outcome = "pai_all_cv_sum_50_percent_tx_alternative0", naming = "pai_50_percent tx_alternative0")
-    write_metrics(outcome = "pai_all_cv_sum_50_percent_all", naming = "pai_50_percent all")
+    for group_name in report_group_names:
+        write_metrics(outcome = "pai_all_cv_sum_50_percent_" + group_name, naming = "pai_50_percent " + group_name)
 
     f.write('\n\nMean observed outcome scores for treatment alternatives (tx_alternative), for patients where this was predicted as optimal and nonoptimal in testset, for the subsample with 50% largest PAIs')
-    write_metrics(outcome = "obs_outcomes_optimal_all_cv_sum_50_percent_tx_alternative1", naming = "mean_obs_outcomes_optimal 50_percent_tx_alternative1")
-    write_metrics(outcome = "obs_outcomes_nonoptimal_all_cv_sum_50_percent_tx_alternative1", naming = "mean_obs_outcomes_nonoptimal 50_percent_tx_alternative1")
-    write_metrics(outcome = "obs_outcomes_optimal_all_cv_sum_50_percent_tx_alternative0", naming = "mean_obs_outcomes_optimal 50_percent_tx_alternative0")
-    write_metrics(outcome = "obs_outcomes_nonoptimal_all_cv_sum_50_percent_tx_alternative0", naming = "mean_obs_outcomes_nonoptimal 50_percent_tx_alternative0")
-    write_metrics(outcome = "obs_outcomes_optimal_all_cv_sum_50_percent_all", naming = "mean_obs_outcomes_optimal 50_percent all")
-    write_metrics(outcome = "obs_outcomes_nonoptimal_all_cv_sum_50_percent_all", naming = "mean_obs_outcomes_nonoptimal 50_percent all")
+    for group_name in report_group_names:
+        naming_group_name = "50_percent all" if group_name == "all" else "50_percent_" + group_name
+        write_metrics(outcome = "obs_outcomes_optimal_all_cv_sum_50_percent_" + group_name, naming = "mean_obs_outcomes_optimal " + naming_group_name)
+        write_metrics(outcome = "obs_outcomes_nonoptimal_all_cv_sum_50_percent_" + group_name, naming = "mean_obs_outcomes_nonoptimal " + naming_group_name)
 
     f.write('\n\nMean of Cohens D for these differences for the subsample with 50% largest PAIs in testset')
-    write_metrics(outcome = "cohens_d_50_percent_tx_alternative1", naming = "Cohens D 50_percent_tx_alternative1")
-    write_metrics(outcome = "cohens_d_50_percent_tx_alternative0", naming = "Cohens D 50_percent_tx_alternative0")
-    write_metrics(outcome = "cohens_d_50_percent_all", naming = "Cohens D 50_percent_all")
+    for group_name in report_group_names:
+        write_metrics(outcome = "cohens_d_50_percent_" + group_name, naming = "Cohens D 50_percent_" + group_name)
 
     f.close()
 
     return results_dict_aggregate
 
 
-def reminder():
-    """Most important prerequisites to execute this code are printed."""
+def reminder(interactive=False):
+    """Most important prerequisites to execute this code are printed, and confirmed by the user if interactive."""
     print("Are data read-in as tab-separated text?")
     print("Have the values 777777, 999999 been assigned to NAs / missing?")
     print("Have you provided the paths to directories?"),
     print("Are binaries coded as 0.5, -0.5?")
-    print("Is group membership coded as 0, 1?")
-    input("Press Enter to continue...")
-
-
-
-if __name__ == '__main__':
-    reminder()
+    print("Is group membership coded as integers, one per treatment arm (e.g. 0, 1, 2)?")
+    if interactive:
+        input("Press Enter to continue...")
+
+
+def load_config(config_path, overrides, default_path_workingdirectory, default_options_overall):
+    """Working directory and options are read from a JSON config file (if given), falling back to the given defaults"""
+    path_workingdirectory = default_path_workingdirectory
+    options_overall = copy.deepcopy(default_options_overall)
+    if config_path is not None:
+        with open(config_path) as fd:
+            config = json.load(fd)
+        if 'number_blas_threads' in config:
+            raise ValueError('number_blas_threads applies to all models of a process, please use --number-blas-threads instead of config file {}'.format(config_path))
+        path_workingdirectory = config.pop('path_workingdirectory', path_workingdirectory)
+        options_overall.update(config)
+    path_workingdirectory = overrides.pop('path_workingdirectory', path_workingdirectory)
+    options_overall.update(overrides)
+
+    return path_workingdirectory, options_overall
+
+
+def run_model(path_workingdirectory, options_overall, pool=None):
+    """All iterations of one model are run (in the worker pool, if given) and aggregated"""
+    start_time = time.time()
+    set_options(path_workingdirectory, options_overall)
     create_folders()
-    print('\nThe scikit-learn version is {}.'.format(sklearn.__version__))
-    runs_list = []
-    outcomes = []
-
-    for i in range (OPTIONS_OVERALL['number_iterations']):
-        runs_list.append(i)
-    #pool = Pool(4)     #cluster
-    #pool.map(do_iterations,runs_list)    #cluster
-    #pool.close()   #cluster
-    #pool.join()    #cluster
-    outcomes[:] = map(do_iterations,runs_list)  #local computer
+
+    jobs = [(path_workingdirectory, options_overall, numrun) for numrun in range(options_overall['number_iterations'])]
+    if pool is None:
+        for job in jobs:
+            run_iteration(job)
+    else:
+        pool.map(run_iteration, jobs)
     results_dict = aggregate_iterations()
 
     elapsed_time = time.time() - start_time
     print('\nThe time for running was {}.'.format(elapsed_time))
     print('Results from all iterations combined were saved at {}.'.format(os.path.join(PATH_WORKINGDIRECTORY,OPTIONS_OVERALL['name_model'],'accuracy')))
-    print('Results from all iterations individually were saved at {}.'.format(os.path.join(PATH_WORKINGDIRECTORY,OPTIONS_OVERALL['name_model'],'individual_rounds')))
+    print('Results from all iterations individually were saved at {}.'.format(os.path.join(PATH_WORKINGDIRECTORY,OPTIONS_OVERALL['name_model'],'individual_rounds')), flush=True)
+
+    return results_dict
+
+
+def read_config_paths():
+    """Config file paths are read from standard input, one per line, until end of input"""
+    print('Waiting for config files on standard input.', flush=True)
+    for line in sys.stdin:
+        if line.strip():
+            yield line.strip()
+
+
+def parse_arguments(argv=None):
+    """Command line arguments are parsed; options not given fall back to the config files and the constants of this script"""
+    parser = argparse.ArgumentParser(description='Low-bias pipeline for the Personalized Advantage Index (PAI).')
+    parser.add_argument('config', nargs='*', help='JSON config files, each defining one model; all models share the same worker processes')
+    parser.add_argument('--serve', action='store_true', help='after the config files given, keep the worker processes alive and read further config file paths from standard input, one per line')
+    parser.add_argument('--interactive', action='store_true', help='ask for confirmation of the prerequisites before running')
+    parser.add_argument('--number-workers', type=int, default=1, help='number of worker processes running iterations in parallel (1 runs them in this process)')
+    parser.add_argument('--number-blas-threads', type=int, help='BLAS threads per process (default: NUMBER_BLAS_THREADS)')
+    parser.add_argument('--working-directory', dest='path_workingdirectory')
+    parser.add_argument('--name-model')
+    parser.add_argument('--number-iterations', type=int)
+    parser.add_argument('--number-folds', type=int)
+    parser.add_argument('--number-arm-workers', type=int)
+    parser.add_argument('--name-features')
+    parser.add_argument('--name-labels')
+    parser.add_argument('--name-groups-id')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Runs every requested model, reusing the initialized worker processes, and returns the exit status"""
+    arguments = parse_arguments(argv)
+    # Defaults are the constants of this script, captured before run_model overwrites the globals with each model's options
+    default_path_workingdirectory = PATH_WORKINGDIRECTORY
+    default_options_overall = copy.deepcopy(OPTIONS_OVERALL)
+    overrides = {key: value for key, value in vars(arguments).items()
+                 if value is not None and (key in default_options_overall or key == 'path_workingdirectory')}
+
+    number_blas_threads = arguments.number_blas_threads if arguments.number_blas_threads is not None else NUMBER_BLAS_THREADS
+
+    reminder(interactive=arguments.interactive)
+    initialize(number_blas_threads)
+    print('\nThe scikit-learn version is {}.'.format(sklearn.__version__))
+
+    pool = None
+    if arguments.number_workers > 1:
+        pool = Pool(arguments.number_workers, initializer=initialize, initargs=(number_blas_threads,))
+
+    if arguments.serve:
+        # Config files given on the command line are run first, then those read from standard input
+        config_paths = itertools.chain(arguments.config, read_config_paths())
+    else:
+        config_paths = arguments.config or [None]
+
+    number_failed = 0
+    try:
+        for config_path in config_paths:
+            try:
+                run_model(*load_config(config_path, dict(overrides), default_path_workingdirectory, default_options_overall), pool=pool)
+            except (Exception, SystemExit):
+                number_failed = number_failed + 1
+                traceback.print_exc()
+                print('The model from config file {} failed.'.format(config_path), flush=True)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return 1 if number_failed > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())